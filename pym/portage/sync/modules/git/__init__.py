@@ -53,6 +53,7 @@ module_spec = {
 			'validate_config': CheckGitConfig,
 			'module_specific_options': (
 				'sync-git-clone-extra-opts',
+				'sync-git-clone-filter',
 				'sync-git-pull-extra-opts',
 				),
 		}
@@ -1,12 +1,23 @@
 # Copyright 2005-2015 Gentoo Foundation
 # Distributed under the terms of the GNU General Public License v2
 
+import io
 import logging
 import subprocess
+import threading
+
+try:
+	from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+	# Python 2
+	ThreadPoolExecutor = None
 
 import portage
 from portage import os
-from portage.util import writemsg_level
+from portage import _encodings
+from portage.util import writemsg_level, shlex_split
+from portage.util.configparser import (ConfigParserError,
+	RawConfigParser, read_configs)
 from portage.output import create_color_func
 good = create_color_func("GOOD")
 bad = create_color_func("BAD")
@@ -14,11 +25,53 @@ warn = create_color_func("WARN")
 from portage.sync.syncbase import NewBase
 
 
+class _GitBatch(object):
+	'''Long-lived `git cat-file --batch-check` process that resolves
+	any number of refs to object names through a single git startup.
+	Use as a context manager; resolve() returns the object name for a
+	ref, or None when the ref does not resolve.'''
+
+	def __init__(self, bin_command, cwd):
+		self._cmd = [bin_command, 'cat-file',
+			'--batch-check=%(objectname)']
+		self._cwd = cwd
+		self._proc = None
+
+	def __enter__(self):
+		self._proc = subprocess.Popen(self._cmd, cwd=self._cwd,
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			universal_newlines=True, bufsize=1)
+		return self
+
+	def resolve(self, ref):
+		self._proc.stdin.write('%s\n' % ref)
+		self._proc.stdin.flush()
+		line = self._proc.stdout.readline().strip()
+		if not line or line.endswith(' missing'):
+			return None
+		return line
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		try:
+			self._proc.stdin.close()
+		except EnvironmentError:
+			pass
+		self._proc.stdout.close()
+		self._proc.wait()
+		return False
+
+
 class GitSync(NewBase):
 	'''Git sync class'''
 
 	short_desc = "Perform sync operations on git based repositories"
 
+	# Executor shared by all GitSync instances, so that independent
+	# repositories can be synced concurrently (see sync_async).
+	# Created on first use.
+	_executor = None
+	_executor_lock = threading.Lock()
+
 	@staticmethod
 	def name():
 		return "GitSync"
@@ -26,17 +79,86 @@ class GitSync(NewBase):
 
 	def __init__(self):
 		NewBase.__init__(self, "git", portage.const.GIT_PACKAGE_ATOM)
+		# Memoized "git rev-parse @{upstream}" result, valid for the
+		# lifetime of this instance since the upstream configuration
+		# does not change while portage runs.
+		self._remote_branch = None
+
+
+	@classmethod
+	def _get_executor(cls):
+		with cls._executor_lock:
+			if cls._executor is None:
+				cls._executor = ThreadPoolExecutor(max_workers=int(
+					os.environ.get('PORTAGE_SYNC_JOBS', '4')))
+		return cls._executor
+
+
+	def sync_async(self, **kwargs):
+		'''Sync the repository in a worker thread of the shared
+		executor, returning a Future that yields the usual
+		(returncode, changed) tuple. Instances submitted together
+		must each target a distinct repository location; git
+		serializes access within a repository itself.'''
+		if ThreadPoolExecutor is None:
+			raise NotImplementedError(
+				"sync_async requires concurrent.futures")
+		return self._get_executor().submit(self.sync, **kwargs)
+
+
+	def _upstream_branch(self):
+		'''Return the remote branch tracked by HEAD, e.g.
+		"origin/master". The branch configuration lives in plain text
+		in .git/HEAD and .git/config, so read those in process and
+		only fall back to exec'ing `git rev-parse @{upstream}` when
+		they cannot be parsed.'''
+		try:
+			with io.open(portage._unicode_encode(
+				self.repo.location + os.sep + '.git' + os.sep + 'HEAD',
+				encoding=_encodings['fs'], errors='strict'),
+				mode='r', encoding=_encodings['repo.content'],
+				errors='replace') as f:
+				head = f.read()
+			if head.startswith('ref: refs/heads/'):
+				branch = head[len('ref: refs/heads/'):].strip()
+				parser = RawConfigParser()
+				read_configs(parser, [os.path.join(
+					self.repo.location, '.git', 'config')])
+				section = 'branch "%s"' % branch
+				remote = parser.get(section, 'remote')
+				merge = parser.get(section, 'merge')
+				if merge.startswith('refs/heads/'):
+					return '%s/%s' % (remote,
+						merge[len('refs/heads/'):])
+		except (EnvironmentError, ConfigParserError):
+			pass
+		return self._git('rev-parse', '--abbrev-ref',
+			'--symbolic-full-name', '@{upstream}').rstrip('\n')
+
+
+	def _git(self, *args, **kwargs):
+		'''Run git with the given arguments in the repo directory and
+		return its decoded output, raising CalledProcessError on
+		failure'''
+		return subprocess.check_output((self.bin_command,) + args,
+			cwd=portage._unicode_encode(self.repo.location),
+			universal_newlines=True, **kwargs)
 
 
 	def exists(self, **kwargs):
 		'''Tests whether the repo actually exists'''
-		return os.path.exists(os.path.join(self.repo.location, '.git'))
+		# .git is a regular file rather than a directory for
+		# worktree and submodule checkouts, so a single lstat
+		# accepting either is both cheaper and more correct than
+		# os.path.exists.
+		return os.path.lexists(self.repo.location + os.sep + '.git')
 
 
 	def new(self, **kwargs):
 		'''Do the initial clone of the repository'''
 		if kwargs:
 			self._kwargs(kwargs)
+		self._remote_branch = None
 		try:
 			if not os.path.exists(self.repo.location):
 				os.makedirs(self.repo.location)
@@ -49,20 +171,25 @@ class GitSync(NewBase):
 		if sync_uri.startswith("file://"):
 			sync_uri = sync_uri[6:]
 
-		git_cmd_opts = ""
+		git_cmd_opts = []
 		if self.settings.get("PORTAGE_QUIET") == "1":
-			git_cmd_opts += " --quiet"
+			git_cmd_opts.append("--quiet")
 		if self.repo.sync_depth is not None:
-			git_cmd_opts += " --depth %d" % self.repo.sync_depth
+			git_cmd_opts.extend(["--depth", "%d" % self.repo.sync_depth])
+		if self.repo.module_specific_options.get('sync-git-clone-filter'):
+			# Partial clone, e.g. blob:none or tree:0, transfers
+			# fewer objects than a shallow clone while keeping the
+			# full commit history available.
+			git_cmd_opts.append("--filter=%s" %
+				self.repo.module_specific_options['sync-git-clone-filter'])
 		if self.repo.module_specific_options.get('sync-git-clone-extra-opts'):
-			git_cmd_opts += " %s" % self.repo.module_specific_options['sync-git-clone-extra-opts']
-		git_cmd = "%s clone%s %s ." % (self.bin_command, git_cmd_opts,
-			portage._shell_quote(sync_uri))
-		writemsg_level(git_cmd + "\n")
-
-		exitcode = portage.process.spawn_bash("cd %s ; exec %s" % (
-				portage._shell_quote(self.repo.location), git_cmd),
-			**self.spawn_kwargs)
+			git_cmd_opts.extend(shlex_split(
+				self.repo.module_specific_options['sync-git-clone-extra-opts']))
+		git_cmd = [self.bin_command, "-C", self.repo.location,
+			"clone"] + git_cmd_opts + [sync_uri, "."]
+		writemsg_level(" ".join(git_cmd) + "\n")
+
+		exitcode = portage.process.spawn(git_cmd, **self.spawn_kwargs)
 		if exitcode != os.EX_OK:
 			msg = "!!! git clone error in %s" % self.repo.location
 			self.logger(self.xterm_titles, msg)
@@ -78,57 +205,103 @@ class GitSync(NewBase):
 		git directly.
 		'''
 
-		git_cmd_opts = ""
+		git_cmd_opts = []
 		quiet = self.settings.get("PORTAGE_QUIET") == "1"
 		if quiet:
-			git_cmd_opts += " --quiet"
+			git_cmd_opts.append("--quiet")
 		if self.repo.module_specific_options.get('sync-git-pull-extra-opts'):
-			git_cmd_opts += " %s" % self.repo.module_specific_options['sync-git-pull-extra-opts']
-		if self.repo.sync_depth is None:
-			git_cmd = "%s pull%s" % (self.bin_command, git_cmd_opts)
+			git_cmd_opts.extend(shlex_split(
+				self.repo.module_specific_options['sync-git-pull-extra-opts']))
+		# A repo cloned with --depth remains shallow even if
+		# sync-depth has since been set to 0, and merging on a
+		# shallow repo tends to fetch large amounts of history, so
+		# treat on-disk shallowness like a configured depth.
+		shallow = os.path.exists(os.path.join(
+			self.repo.location, '.git', 'shallow'))
+		remote_branch = None
+		if self.repo.sync_depth is None and not shallow:
+			# Use `git fetch` followed by `git merge --ff-only
+			# FETCH_HEAD` rather than `git pull`, so that the merge
+			# can be skipped entirely when the fetch brought in
+			# nothing new.
+			git_cmd = [self.bin_command, "-C", self.repo.location,
+				"fetch"] + git_cmd_opts
 		else:
 			# Since the default merge strategy typically fails when
 			# the depth is not unlimited, use `git fetch` followed by
 			# `git reset --merge`.
-			try:
-				remote_branch = portage._unicode_decode(
-					subprocess.check_output([self.bin_command, 'rev-parse',
-					'--abbrev-ref', '--symbolic-full-name', '@{upstream}'],
-					cwd=portage._unicode_encode(self.repo.location))).rstrip('\n')
-			except subprocess.CalledProcessError as e:
-				msg = "!!! git rev-parse error in %s" % self.repo.location
-				self.logger(self.xterm_titles, msg)
-				writemsg_level(msg + "\n", level=logging.ERROR, noiselevel=-1)
-				return (e.returncode, False)
+			remote_branch = self._remote_branch
+			if remote_branch is None:
+				try:
+					remote_branch = self._upstream_branch()
+				except subprocess.CalledProcessError as e:
+					msg = "!!! git rev-parse error in %s" % self.repo.location
+					self.logger(self.xterm_titles, msg)
+					writemsg_level(msg + "\n", level=logging.ERROR, noiselevel=-1)
+					return (e.returncode, False)
+				self._remote_branch = remote_branch
 
-			git_cmd_opts += " --depth %d" % self.repo.sync_depth
-			git_cmd = "%s fetch %s%s" % (self.bin_command,
-				remote_branch.partition('/')[0], git_cmd_opts)
+			if self.repo.sync_depth is not None:
+				git_cmd_opts.extend(
+					["--depth", "%d" % self.repo.sync_depth])
+			git_cmd = [self.bin_command, "-C", self.repo.location,
+				"fetch", remote_branch.partition('/')[0]] + git_cmd_opts
 
-		writemsg_level(git_cmd + "\n")
+		writemsg_level(" ".join(git_cmd) + "\n")
 
-		rev_cmd = [self.bin_command, "rev-list", "--max-count=1", "HEAD"]
-		previous_rev = subprocess.check_output(rev_cmd,
-			cwd=portage._unicode_encode(self.repo.location))
+		# One long-lived `git cat-file --batch-check` process serves
+		# every ref lookup below through a single git startup. It is
+		# started before the fetch so its own startup overlaps the
+		# network transfer; HEAD is only resolved afterwards, which
+		# is equivalent since the fetch never moves HEAD.
+		with _GitBatch(self.bin_command,
+			portage._unicode_encode(self.repo.location)) as batch:
 
-		exitcode = portage.process.spawn_bash("cd %s ; exec %s" % (
-				portage._shell_quote(self.repo.location), git_cmd),
-			**self.spawn_kwargs)
+			exitcode = portage.process.spawn(git_cmd, **self.spawn_kwargs)
 
-		if exitcode == os.EX_OK and self.repo.sync_depth is not None:
-			reset_cmd = [self.bin_command, 'reset', '--merge', remote_branch]
-			if quiet:
-				reset_cmd.append('--quiet')
-			exitcode = subprocess.call(reset_cmd,
-				cwd=portage._unicode_encode(self.repo.location))
+			if exitcode == os.EX_OK:
+				previous_rev = batch.resolve('HEAD')
+				if remote_branch is None:
+					# Merge only when the fetch brought in something
+					# new.
+					fetch_rev = batch.resolve('FETCH_HEAD')
+					if fetch_rev is not None and \
+						fetch_rev == previous_rev:
+						return (os.EX_OK, False)
+					merge_cmd = [self.bin_command, 'merge',
+						'--ff-only', 'FETCH_HEAD']
+					if quiet:
+						merge_cmd.append('--quiet')
+					exitcode = subprocess.call(merge_cmd,
+						cwd=portage._unicode_encode(self.repo.location))
+				else:
+					# Skip the reset when HEAD already matches the
+					# fetched remote branch.
+					remote_rev = batch.resolve(remote_branch)
+					if remote_rev is not None and \
+						remote_rev == previous_rev:
+						return (os.EX_OK, False)
+					reset_cmd = [self.bin_command, 'reset', '--merge',
+						remote_branch]
+					if quiet:
+						reset_cmd.append('--quiet')
+					exitcode = subprocess.call(reset_cmd,
+						cwd=portage._unicode_encode(self.repo.location))
+					if exitcode == os.EX_OK:
+						# The reset pins HEAD to the remote revision,
+						# so no further lookup is needed to know that
+						# the tree changed.
+						return (os.EX_OK, True)
 
-		if exitcode != os.EX_OK:
-			msg = "!!! git pull error in %s" % self.repo.location
-			self.logger(self.xterm_titles, msg)
-			writemsg_level(msg + "\n", level=logging.ERROR, noiselevel=-1)
-			return (exitcode, False)
+			if exitcode != os.EX_OK:
+				msg = "!!! git sync error in %s" % self.repo.location
+				self.logger(self.xterm_titles, msg)
+				writemsg_level(msg + "\n", level=logging.ERROR, noiselevel=-1)
+				return (exitcode, False)
 
-		current_rev = subprocess.check_output(rev_cmd,
-			cwd=portage._unicode_encode(self.repo.location))
+			# A fast-forward merge normally lands HEAD on FETCH_HEAD,
+			# but when the local branch was already ahead it is a
+			# no-op, so verify that the revision actually changed.
+			current_rev = batch.resolve('HEAD')
 
 		return (os.EX_OK, current_rev != previous_rev)